@@ -0,0 +1,369 @@
+"""
+Connection broker for the Tivo platform.
+
+A TiVo only accepts a handful of network remote connections.  The broker
+keeps a single upstream connection per box, serializes every command onto
+it and fans each line the box sends (CH_STATUS pushes and replies) out to
+all downstream clients.  Home Assistant entities attach in-process; other
+remote apps can optionally connect to a local 31339-compatible port.
+"""
+import logging
+import queue
+import socket
+import socketserver
+import threading
+import time
+
+_LOGGER = logging.getLogger(__name__)
+
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 1
+RESPONSE_TIMEOUT = 0.5
+RECONNECT_DELAY = 10
+RECONNECT_MAX_DELAY = 300
+STATUS_MAX_AGE = 30
+STATUS_TIMEOUT = 5
+CLIENT_QUEUE_SIZE = 100
+CLIENT_SEND_TIMEOUT = 5
+
+# Notice a box that lost power without closing the connection
+KEEPALIVE_IDLE = 30
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_COUNT = 3
+
+
+class TivoBroker:
+    """Share one upstream remote connection between many clients."""
+
+    def __init__(self, host, port, breaker=None, listen_port=None,
+                 listen_host='127.0.0.1'):
+        self.host = host
+        self.port = port
+        self.breaker = breaker
+        self.listen_port = listen_port
+        self.listen_host = listen_host
+
+        self._sock = None
+        self._lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._seq = 0
+        self._last_line = None
+        self._status = None
+        self._status_time = 0
+
+        self._clients = set()
+        self._clients_lock = threading.Lock()
+        self._listeners = []
+
+        self._stopped = threading.Event()
+        self._server = None
+
+    @property
+    def status(self):
+        """Return the last CH_STATUS line pushed by the box, if any."""
+        return self._status
+
+    def add_listener(self, callback):
+        """Call callback(line) from the reader thread for every upstream line."""
+        self._listeners.append(callback)
+
+    def start(self):
+        if self.listen_port:
+            try:
+                self._server = _BrokerServer(
+                    (self.listen_host, self.listen_port), _BrokerHandler, self)
+            except OSError as err:
+                # Still broker for Home Assistant, just without the endpoint
+                _LOGGER.error("Unable to listen on %s:%d for %s: %s",
+                              self.listen_host, self.listen_port, self.host, err)
+            else:
+                threading.Thread(target=self._server.serve_forever, daemon=True,
+                                 name='tivo-broker-listen-' + self.host).start()
+                _LOGGER.info("Brokering %s on %s:%d", self.host,
+                             self.listen_host, self.listen_port)
+        threading.Thread(target=self._read_upstream, daemon=True,
+                         name='tivo-broker-' + self.host).start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+        with self._lock:
+            self._drop()
+        with self._clients_lock:
+            clients = list(self._clients)
+            self._clients.clear()
+        for client in clients:
+            client.close()
+
+    def send(self, data, timeout=RESPONSE_TIMEOUT):
+        """Send a command upstream and return the next line from the box.
+
+        An empty command is a status request: while connected it is
+        answered from the cached CH_STATUS line for up to STATUS_MAX_AGE
+        seconds.  After that the upstream connection is reopened so the
+        box greets us with its current status, as it did before the
+        broker.  Returns None if no status arrives within timeout.
+        """
+        if not data:
+            with self._lock:
+                if self._sock is not None:
+                    if self._status and \
+                            time.monotonic() - self._status_time < STATUS_MAX_AGE:
+                        return self._status
+                    # The reader reconnects straight away after this
+                    self._drop()
+                    # Like a fresh direct connection, give the greeting time
+                    timeout = max(timeout, STATUS_TIMEOUT)
+            with self._cond:
+                self._cond.wait_for(lambda: self._status is not None, timeout)
+                return self._status
+
+        with self._cond:
+            seq = self._seq
+        self.forward(data)
+        with self._cond:
+            if self._cond.wait_for(lambda: self._seq != seq, timeout):
+                return self._last_line
+        return self._status
+
+    def forward(self, data):
+        """Write a command upstream without waiting for a reply.
+
+        Only the reader thread connects, so reconnects stay under its
+        backoff; while disconnected this raises instead.
+        """
+        with self._lock:
+            if self._sock is None:
+                if self.breaker is not None:
+                    self.breaker.check()
+                raise ConnectionError("{} is not connected".format(self.host))
+            try:
+                self._sock.sendall(data.encode())
+            except OSError:
+                self._drop()
+                raise
+
+    def _connect(self):
+        # Caller holds self._lock
+        if self._sock is not None:
+            return
+        if self.breaker is not None:
+            self.breaker.check()
+        try:
+            sock = socket.create_connection((self.host, self.port),
+                                            CONNECT_TIMEOUT)
+        except OSError:
+            if self.breaker is not None:
+                self.breaker.failure()
+            raise
+        # The breaker is only cleared once the box actually sends something;
+        # a box with no free slots accepts and then closes straight away
+        sock.settimeout(READ_TIMEOUT)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        for option, value in (('TCP_KEEPIDLE', KEEPALIVE_IDLE),
+                              ('TCP_KEEPINTVL', KEEPALIVE_INTERVAL),
+                              ('TCP_KEEPCNT', KEEPALIVE_COUNT)):
+            if hasattr(socket, option):
+                sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+        self._sock = sock
+
+    def _drop(self):
+        # Caller holds self._lock
+        if self._sock is not None:
+            try:
+                # Wakes the reader thread if it is blocked in recv
+                self._sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self._sock.close()
+            self._sock = None
+        # The cached status is only trustworthy while connected
+        with self._cond:
+            self._status = None
+
+    def _read_upstream(self):
+        buf = b''
+        current = None
+        got_data = False
+        delay = RECONNECT_DELAY
+        while not self._stopped.is_set():
+            sock = self._sock
+            if sock is None:
+                try:
+                    with self._lock:
+                        self._connect()
+                except OSError as err:
+                    _LOGGER.debug("Broker connect to %s failed: %s",
+                                  self.host, err)
+                    self._stopped.wait(delay)
+                    delay = min(delay * 2, RECONNECT_MAX_DELAY)
+                continue
+
+            if sock is not current:
+                current = sock
+                buf = b''
+                got_data = False
+
+            try:
+                chunk = sock.recv(1024)
+            except socket.timeout:
+                continue
+            except OSError:
+                chunk = b''
+
+            if not chunk:
+                with self._lock:
+                    if self._sock is not sock:
+                        # Replaced on purpose, e.g. to refresh the status
+                        continue
+                    self._drop()
+                if not got_data:
+                    # Accepted then closed: usually every remote slot is taken
+                    _LOGGER.debug("%s closed the connection without a status",
+                                  self.host)
+                    if self.breaker is not None:
+                        self.breaker.failure()
+                self._stopped.wait(delay)
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+                continue
+
+            if not got_data:
+                got_data = True
+                delay = RECONNECT_DELAY
+                if self.breaker is not None:
+                    self.breaker.success()
+
+            buf += chunk.replace(b'\n', b'\r')
+            *lines, buf = buf.split(b'\r')
+            for line in lines:
+                if line:
+                    self._dispatch(line.decode(errors='replace'))
+
+    def _dispatch(self, line):
+        with self._cond:
+            if line.startswith('CH_STATUS'):
+                self._status = line
+                self._status_time = time.monotonic()
+            self._last_line = line
+            self._seq += 1
+            self._cond.notify_all()
+
+        self._broadcast(line)
+        for callback in self._listeners:
+            try:
+                callback(line)
+            except Exception:
+                _LOGGER.exception("Error in broker listener for %s", self.host)
+
+    def _broadcast(self, line):
+        # Never blocks: each client has its own queue and writer thread
+        data = (line + '\r').encode()
+        with self._clients_lock:
+            clients = list(self._clients)
+        for client in clients:
+            if not client.put(data):
+                _LOGGER.debug("Dropping slow broker client for %s", self.host)
+                self._remove_client(client)
+
+    def _add_client(self, client):
+        with self._clients_lock:
+            self._clients.add(client)
+        # A real TiVo greets new connections with the current status
+        status = self._status
+        if status:
+            client.put((status + '\r').encode())
+
+    def _remove_client(self, client):
+        with self._clients_lock:
+            self._clients.discard(client)
+        client.close()
+
+
+class _BrokerClient:
+    """A downstream connection with a bounded outgoing queue."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self._queue = queue.Queue(CLIENT_QUEUE_SIZE)
+        self._closed = False
+        sock.settimeout(CLIENT_SEND_TIMEOUT)
+        threading.Thread(target=self._write, daemon=True,
+                         name='tivo-broker-client').start()
+
+    def put(self, data):
+        """Queue data for sending; False if the client has fallen behind."""
+        if self._closed:
+            return False
+        try:
+            self._queue.put_nowait(data)
+        except queue.Full:
+            return False
+        return True
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self._queue.put_nowait(None)
+        except queue.Full:
+            pass
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _write(self):
+        while True:
+            data = self._queue.get()
+            if data is None or self._closed:
+                return
+            try:
+                self.sock.sendall(data)
+            except OSError:
+                self.close()
+                return
+
+
+class _BrokerServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, handler, broker):
+        self.broker = broker
+        super().__init__(address, handler)
+
+
+class _BrokerHandler(socketserver.BaseRequestHandler):
+    """Relay commands from one downstream client to the shared upstream."""
+
+    def handle(self):
+        broker = self.server.broker
+        client = _BrokerClient(self.request)
+        broker._add_client(client)
+        buf = b''
+        try:
+            while True:
+                try:
+                    chunk = self.request.recv(1024)
+                except socket.timeout:
+                    # The timeout is there for sends; idle clients are fine
+                    continue
+                if not chunk:
+                    break
+                buf += chunk.replace(b'\n', b'\r')
+                *commands, buf = buf.split(b'\r')
+                for command in commands:
+                    if not command:
+                        continue
+                    try:
+                        broker.forward(command.decode(errors='replace') + '\r')
+                    except OSError as err:
+                        _LOGGER.debug("Broker dropped command for %s: %s",
+                                      broker.host, err)
+        except OSError as err:
+            _LOGGER.debug("Broker client for %s dropped: %s", broker.host, err)
+        finally:
+            broker._remove_client(client)
@@ -0,0 +1,240 @@
+"""
+Compact on-disk guide store for the Tivo platform.
+
+Listings are written once per refresh into a single binary file and then
+memory-mapped, so lookups are binary searches over shared pages rather
+than Python dicts, and a restart reuses the file without parsing it.
+
+Layout (all integers little-endian):
+
+    header      magic, version, counts, listing end and section offsets;
+                the listing end is when the first channel runs out
+    str index   (n_strings + 1) uint32 offsets into the string blob
+    str blob    utf-8 titles, callsigns, channel numbers and thumbnails
+    channels    per channel: key id, callsign id, first event, event count
+                sorted by channel number string
+    events      per event: channel index, start, end, title id, image id
+                grouped by channel and sorted by start time
+"""
+import mmap
+import os
+import struct
+import tempfile
+
+MAGIC = b'TIVG'
+VERSION = 1
+
+_HEADER = struct.Struct('<4sHHIIIIIIII')
+_OFFSET = struct.Struct('<I')
+_CHANNEL = struct.Struct('<IIII')
+_EVENT = struct.Struct('<IIIII')
+
+
+class GuideWriter:
+    """Collect channels and events, then write them out in one go."""
+
+    def __init__(self):
+        self._strings = []
+        self._string_ids = {}
+        self._channels = {}
+
+    def _intern(self, value):
+        value = value or ''
+        sid = self._string_ids.get(value)
+        if sid is None:
+            sid = self._string_ids[value] = len(self._strings)
+            self._strings.append(value)
+        return sid
+
+    def add_channel(self, channel, callsign):
+        self._channels.setdefault(
+            channel, [self._intern(channel), self._intern(callsign), {}])
+
+    def add_event(self, channel, start, end, title, image):
+        if channel not in self._channels:
+            self.add_channel(channel, '')
+        # Keyed by start so overlapping fetches don't duplicate listings
+        self._channels[channel][2][int(start)] = (
+            int(end), self._intern(title), self._intern(image))
+
+    def write(self, path):
+        """Write the store atomically: readers see the old file or the new one."""
+        index = []
+        blob = bytearray()
+        for value in self._strings:
+            index.append(len(blob))
+            blob += value.encode('utf8')
+        index.append(len(blob))
+
+        channels = bytearray()
+        events = bytearray()
+        n_events = 0
+        last_end = None
+        for ch_index, channel in enumerate(sorted(self._channels)):
+            key_id, callsign_id, ch_events = self._channels[channel]
+            channels += _CHANNEL.pack(
+                key_id, callsign_id, n_events, len(ch_events))
+            ch_end = 0
+            for start in sorted(ch_events):
+                end, title_id, image_id = ch_events[start]
+                events += _EVENT.pack(ch_index, start, end, title_id, image_id)
+                ch_end = max(ch_end, end)
+            if ch_events:
+                last_end = ch_end if last_end is None else min(last_end, ch_end)
+            n_events += len(ch_events)
+
+        str_index_off = _HEADER.size
+        str_blob_off = str_index_off + _OFFSET.size * len(index)
+        chan_off = str_blob_off + len(blob)
+        event_off = chan_off + len(channels)
+
+        header = _HEADER.pack(
+            MAGIC, VERSION, 0, len(index) - 1, len(self._channels), n_events,
+            last_end or 0, str_index_off, str_blob_off, chan_off, event_off)
+
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                   prefix='.tivo_guide')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(header)
+                for offset in index:
+                    f.write(_OFFSET.pack(offset))
+                f.write(blob)
+                f.write(channels)
+                f.write(events)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+
+class GuideStore:
+    """Read-only, memory-mapped view of a file written by GuideWriter."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, _, self._n_strings, self._n_channels, self._n_events,
+         self._last_end, self._str_index_off, self._str_blob_off, self._chan_off,
+         self._event_off) = _HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION or not self._in_bounds():
+            self._map.close()
+            raise ValueError("{} is not a guide store".format(path))
+
+    def _in_bounds(self):
+        # Sections must be in order and fit the file, or lookups would
+        # read past the end of the map
+        size = len(self._map)
+        str_index_end = self._str_index_off + _OFFSET.size * (self._n_strings + 1)
+        chan_end = self._chan_off + _CHANNEL.size * self._n_channels
+        event_end = self._event_off + _EVENT.size * self._n_events
+        if not (_HEADER.size <= self._str_index_off and
+                str_index_end <= self._str_blob_off <= self._chan_off and
+                chan_end <= self._event_off and event_end <= size):
+            return False
+        blob_len = struct.unpack_from(
+            '<I', self._map, self._str_index_off + _OFFSET.size * self._n_strings)[0]
+        if self._str_blob_off + blob_len > self._chan_off:
+            return False
+
+        # Channel records are few, so check them all up front; event
+        # records are checked as they are read
+        for ch_index in range(self._n_channels):
+            key_id, callsign_id, first, count = self._channel(ch_index)
+            if (key_id >= self._n_strings or callsign_id >= self._n_strings or
+                    first + count > self._n_events):
+                return False
+        return True
+
+    @classmethod
+    def open(cls, path):
+        """Return a store for path, or None if it is missing or unreadable."""
+        try:
+            return cls(path)
+        except (OSError, ValueError, struct.error):
+            return None
+
+    def _string(self, sid):
+        if sid >= self._n_strings:
+            raise ValueError("string id {} out of range".format(sid))
+        start, end = struct.unpack_from(
+            '<II', self._map, self._str_index_off + _OFFSET.size * sid)
+        return self._map[self._str_blob_off + start:
+                         self._str_blob_off + end].decode('utf8')
+
+    def _channel(self, ch_index):
+        return _CHANNEL.unpack_from(
+            self._map, self._chan_off + _CHANNEL.size * ch_index)
+
+    def _event(self, ev_index):
+        return _EVENT.unpack_from(
+            self._map, self._event_off + _EVENT.size * ev_index)
+
+    def _find_channel(self, channel):
+        lo, hi = 0, self._n_channels
+        while lo < hi:
+            mid = (lo + hi) // 2
+            key = self._string(self._channel(mid)[0])
+            if key < channel:
+                lo = mid + 1
+            elif key > channel:
+                hi = mid
+            else:
+                return self._channel(mid)
+        return None
+
+    def _find_event(self, channel, when):
+        """Return the event airing at when on channel, or None."""
+        record = self._find_channel(channel)
+        if record is None or not record[3]:
+            return None
+        first, count = record[2], record[3]
+        lo, hi = first, first + count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._event(mid)[1] <= when:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo > first:
+            event = self._event(lo - 1)
+            if event[1] <= when < event[2]:
+                return event
+        return None
+
+    def covers(self, when):
+        """True if every channel still has listings at when."""
+        return when < self._last_end
+
+    # A damaged record reads as a missing listing rather than raising
+    # into the status poll
+
+    def get_callsign(self, channel):
+        try:
+            record = self._find_channel(channel)
+            if record is None:
+                return None
+            return self._string(record[1])
+        except (struct.error, ValueError):
+            return None
+
+    def get_title(self, channel, when):
+        try:
+            event = self._find_event(channel, when)
+            if event is None:
+                return None
+            return self._string(event[3])
+        except (struct.error, ValueError):
+            return None
+
+    def get_image(self, channel, when):
+        """Return the thumbnail airing at when, or None if nothing is."""
+        try:
+            event = self._find_event(channel, when)
+            if event is None:
+                return None
+            return self._string(event[4])
+        except (struct.error, ValueError):
+            return None
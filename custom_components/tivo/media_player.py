@@ -21,6 +21,9 @@ import json
 import urllib
 from urllib.parse import urlencode
 import os.path
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
 
 from homeassistant import util
 from homeassistant.components.media_player import (
@@ -30,24 +33,38 @@ from homeassistant.components.media_player.const import (
     SUPPORT_TURN_OFF, SUPPORT_TURN_ON, SUPPORT_STOP,
     SUPPORT_NEXT_TRACK, SUPPORT_PREVIOUS_TRACK, SUPPORT_PLAY)
 from homeassistant.const import (
-    CONF_DEVICE, CONF_HOST, CONF_NAME, STATE_OFF, STATE_STANDBY, STATE_PLAYING, CONF_PORT, CONF_USERNAME, CONF_PASSWORD)
+    CONF_DEVICE, CONF_HOST, CONF_NAME, STATE_OFF, STATE_STANDBY, STATE_PLAYING, CONF_PORT, CONF_USERNAME, CONF_PASSWORD,
+    EVENT_HOMEASSISTANT_STOP, ATTR_ENTITY_ID, ATTR_COMMAND)
 import homeassistant.helpers.config_validation as cv
 #from homeassistant.helpers.event import (track_utc_time_change, track_time_interval)
 from homeassistant.helpers.event import track_time_interval
 from homeassistant.util.json import load_json, save_json
 
+from .broker import TivoBroker
+from .guide import GuideStore, GuideWriter
+
 _LOGGER = logging.getLogger(__name__)
 
 DEFAULT_NAME = 'Tivo Receiver'
 DEFAULT_PORT = 31339
 DEFAULT_DEVICE = '0'
+DEFAULT_BROKER_HOST = '127.0.0.1'
 
 CONF_ZAPUSER = 'zapuser'
 CONF_ZAPPASS = 'zappass'
 CONF_DEBUG   = 'debug'
+CONF_ZAPHOURS = 'zaphours'
+CONF_BROKER  = 'broker'
+CONF_BROKER_PORT = 'broker_port'
+CONF_BROKER_HOST = 'broker_host'
 
 SCAN_INTERVAL = timedelta(seconds=10)
 ZAP_SCAN_INTERVAL = timedelta(seconds=300)
+ZAP_CHUNK_HOURS = 6
+ZAP_MAX_HOURS = 72
+ZAP_NO_IMAGE = "https://tvlistings.zap2it.com/assets/images/noImage165x220.jpg"
+
+GUIDE_FILE = '.tivo_guide.bin'
 
 SUPPORT_TIVO = SUPPORT_PAUSE |\
     SUPPORT_PLAY_MEDIA | SUPPORT_STOP | SUPPORT_NEXT_TRACK |\
@@ -55,6 +72,58 @@ SUPPORT_TIVO = SUPPORT_PAUSE |\
     SUPPORT_PREVIOUS_TRACK | SUPPORT_PLAY
 
 DATA_TIVO = "data_tivo"
+DATA_TIVO_CAPTURE = "data_tivo_capture"
+DATA_TIVO_BREAKERS = "data_tivo_breakers"
+DATA_TIVO_BROKERS = "data_tivo_brokers"
+DATA_TIVO_ENTITIES = "data_tivo_entities"
+
+DOMAIN = 'tivo'
+
+CAPTURE_SIZE = 500
+CAPTURE_FILE = 'tivo_capture.json'
+
+BREAKER_THRESHOLD = 3
+PROBE_INTERVAL = timedelta(seconds=30)
+PROBE_TIMEOUT = 1
+
+BULK_TIMEOUT = 10
+BULK_MAX_WORKERS = 16
+
+ATTR_FILENAME = 'filename'
+ATTR_MACRO    = 'macro'
+ATTR_CMDTYPE  = 'cmdtype'
+ATTR_CHANNEL  = 'channel'
+ATTR_TIMEOUT  = 'timeout'
+
+SERVICE_DUMP_CAPTURE = 'dump_capture'
+SERVICE_BULK_COMMAND = 'bulk_command'
+
+EVENT_BULK_RESULT = 'tivo_bulk_result'
+
+# Entity methods a bulk_command can run; channel_set needs a channel
+BULK_MACROS = {
+    'turn_on':     lambda tivo, data: tivo.turn_on(),
+    'turn_off':    lambda tivo, data: tivo.turn_off(),
+    'channel_set': lambda tivo, data: tivo.channel_set(data[ATTR_CHANNEL]),
+    'live_tv':     lambda tivo, data: tivo.show_live,
+    'guide':       lambda tivo, data: tivo.show_guide,
+}
+
+DUMP_CAPTURE_SCHEMA = vol.Schema({
+    # A bare file name only, so the dump always lands in the config directory
+    vol.Optional(ATTR_FILENAME, default=CAPTURE_FILE):
+        vol.All(cv.string, vol.Match(r'^[\w-][\w.-]*$')),
+})
+
+BULK_COMMAND_SCHEMA = vol.All(vol.Schema({
+    vol.Optional(ATTR_ENTITY_ID): cv.entity_ids,
+    vol.Exclusive(ATTR_COMMAND, 'action'): cv.string,
+    vol.Exclusive(ATTR_MACRO, 'action'): vol.In(list(BULK_MACROS)),
+    vol.Optional(ATTR_CMDTYPE, default='IRCODE'): cv.string,
+    vol.Optional(ATTR_CHANNEL): cv.string,
+    vol.Optional(ATTR_TIMEOUT, default=BULK_TIMEOUT):
+        vol.All(vol.Coerce(float), vol.Range(min=0, min_included=False)),
+}), cv.has_at_least_one_key(ATTR_COMMAND, ATTR_MACRO))
 
 PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend({
     vol.Optional(CONF_HOST): cv.string,
@@ -63,7 +132,12 @@ PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend({
     vol.Optional(CONF_DEVICE, default=DEFAULT_DEVICE): cv.string,
     vol.Optional(CONF_ZAPUSER, default=""): cv.string,
     vol.Optional(CONF_ZAPPASS, default=""): cv.string,
-    vol.Optional(CONF_DEBUG, default=0): cv.string
+    vol.Optional(CONF_DEBUG, default=0): cv.string,
+    vol.Optional(CONF_ZAPHOURS, default=1):
+        vol.All(vol.Coerce(int), vol.Range(min=1, max=ZAP_MAX_HOURS)),
+    vol.Optional(CONF_BROKER, default=0): cv.string,
+    vol.Optional(CONF_BROKER_PORT): cv.port,
+    vol.Optional(CONF_BROKER_HOST, default=DEFAULT_BROKER_HOST): cv.string
 })
 
 def setup_platform(hass, config, add_devices, discovery_info=None):
@@ -78,8 +152,20 @@ def setup_platform(hass, config, add_devices, discovery_info=None):
     zapclient = None
     debug = config.get(CONF_DEBUG)
 
+    capture = hass.data.get(DATA_TIVO_CAPTURE)
+    if capture is None:
+        capture = TivoCapture()
+        hass.data[DATA_TIVO_CAPTURE] = capture
+
+    breakers = hass.data.setdefault(DATA_TIVO_BREAKERS, {})
+    brokers = hass.data.setdefault(DATA_TIVO_BROKERS, {})
+    use_broker = bool(int(config.get(CONF_BROKER))) or CONF_BROKER_PORT in config
+    broker_port = config.get(CONF_BROKER_PORT)
+
     if zapuser and zappass:
-        zapclient = Zap2ItClient(zapuser, zappass, debug)
+        zapclient = Zap2ItClient(zapuser, zappass, debug, capture,
+                                 hass.config.path(GUIDE_FILE),
+                                 config.get(CONF_ZAPHOURS))
 
     if CONF_HOST in config:
         hosts.append([
@@ -88,7 +174,8 @@ def setup_platform(hass, config, add_devices, discovery_info=None):
             config.get(CONF_PORT),
             config.get(CONF_DEVICE),
             zapclient,
-            debug
+            debug,
+            capture
         ])
 
     # Discovery not tested and likely not working
@@ -99,37 +186,137 @@ def setup_platform(hass, config, add_devices, discovery_info=None):
             # attempt to discover additional Tivo units
             device = 0
             for name, ip_addr in zc_hosts.items():
-                hosts.append([name + " TiVo", ip_addr, DEFAULT_PORT, device, zapclient, debug])
+                hosts.append([name + " TiVo", ip_addr, DEFAULT_PORT, device, zapclient, debug, capture])
                 device = device + 1
         else:
             # bail out and just go forward with uPnP data
             if DEFAULT_DEVICE not in known_devices:
-                hosts.append([name, host, DEFAULT_PORT, DEFAULT_DEVICE, zapclient, debug])
+                hosts.append([name, host, DEFAULT_PORT, DEFAULT_DEVICE, zapclient, debug, capture])
 
     tivos = []
 
     for host in hosts:
-        tivos.append(TivoDevice(*host))
-        known_devices.append(host[-1])
+        breaker = breakers.get(host[1])
+        if breaker is None:
+            breaker = breakers[host[1]] = TivoBreaker(host[1], host[2])
+
+        broker = brokers.get(host[1])
+        if broker is None and use_broker:
+            broker = brokers[host[1]] = TivoBroker(
+                host[1], host[2], breaker, broker_port,
+                config.get(CONF_BROKER_HOST))
+            broker.start()
+            hass.bus.listen_once(EVENT_HOMEASSISTANT_STOP,
+                                 lambda event, broker=broker: broker.stop())
+            if broker_port:
+                # Discovered units each get the next local port
+                broker_port += 1
+
+        tivos.append(TivoDevice(*host, breaker=breaker, broker=broker))
+        known_devices.append(host[3])
 
     add_devices(tivos)
     hass.data[DATA_TIVO] = known_devices
+    hass.data.setdefault(DATA_TIVO_ENTITIES, []).extend(tivos)
 
     def update_status(event_time):
         for tivo in tivos:
+            if not tivo.available:
+                # Left to probe_breakers so a dead box costs nothing here
+                continue
             if tivo.debug:
-                _LOGGER.info("update_status: %s", tivo)
-            tivo.get_status()
+                _LOGGER.debug("update_status: %s", tivo)
+            try:
+                tivo.get_status()
+            except OSError as err:
+                _LOGGER.warning("Unable to update %s: %s", tivo.name, err)
+
+    def probe_breakers(event_time):
+        for tivo in tivos:
+            if tivo.available:
+                continue
+            if tivo.breaker.probe():
+                _LOGGER.info("%s is reachable again", tivo.name)
+                try:
+                    tivo.get_status()
+                except OSError:
+                    pass
 
     def zap2it_update(event_time):
         zapclient.update()
 
+    def dump_capture(service):
+        # Runs in the executor, so the file write stays off the polling path
+        filename = hass.config.path(service.data.get(ATTR_FILENAME))
+        capture.dump(filename)
+        _LOGGER.info("Wrote %d TiVo capture entries to %s", len(capture), filename)
+
+    def bulk_command(service):
+        entity_ids = service.data.get(ATTR_ENTITY_ID)
+        # Every platform instance adds to this list; the service is shared
+        targets = [tivo for tivo in hass.data[DATA_TIVO_ENTITIES]
+                   if entity_ids is None or tivo.entity_id in entity_ids]
+        action = service.data.get(ATTR_COMMAND) or service.data.get(ATTR_MACRO)
+        if service.data.get(ATTR_MACRO) == 'channel_set' and \
+                ATTR_CHANNEL not in service.data:
+            _LOGGER.error("bulk_command channel_set requires a channel")
+            return
+
+        results = run_bulk(targets, service.data)
+        _LOGGER.info("bulk_command %s: %s", action, results)
+        # Macros change state from worker threads; write it out now
+        for tivo in targets:
+            if results.get(tivo.entity_id) == 'ok' and tivo.hass is not None:
+                tivo.schedule_update_ha_state()
+        hass.bus.fire(EVENT_BULK_RESULT, {
+            ATTR_COMMAND: action,
+            'results': results,
+        })
+
     track_time_interval(hass, update_status, SCAN_INTERVAL)
+    track_time_interval(hass, probe_breakers, PROBE_INTERVAL)
     if zapclient:
         track_time_interval(hass, zap2it_update, ZAP_SCAN_INTERVAL)
 
+    if not hass.services.has_service(DOMAIN, SERVICE_DUMP_CAPTURE):
+        hass.services.register(DOMAIN, SERVICE_DUMP_CAPTURE, dump_capture,
+                               schema=DUMP_CAPTURE_SCHEMA)
+    if not hass.services.has_service(DOMAIN, SERVICE_BULK_COMMAND):
+        hass.services.register(DOMAIN, SERVICE_BULK_COMMAND, bulk_command,
+                               schema=BULK_COMMAND_SCHEMA)
+
     return True
 
+def run_bulk(tivos, data):
+    """Run a command or macro on every TiVo at once.
+
+    Returns a result per entity: 'ok', 'timeout', or the error message.
+    A box that times out is left to finish in the background.
+    """
+    if not tivos:
+        return {}
+
+    if ATTR_MACRO in data:
+        macro = BULK_MACROS[data[ATTR_MACRO]]
+        action = lambda tivo: macro(tivo, data)
+    else:
+        action = lambda tivo: tivo.send_code(data[ATTR_COMMAND], data[ATTR_CMDTYPE])
+
+    executor = ThreadPoolExecutor(max_workers=min(len(tivos), BULK_MAX_WORKERS))
+    futures = {executor.submit(action, tivo): tivo for tivo in tivos}
+    done, _ = wait(futures, timeout=data.get(ATTR_TIMEOUT, BULK_TIMEOUT))
+    executor.shutdown(wait=False)
+
+    results = {}
+    for future, tivo in futures.items():
+        if future not in done:
+            results[tivo.entity_id] = 'timeout'
+        elif future.exception() is not None:
+            results[tivo.entity_id] = str(future.exception())
+        else:
+            results[tivo.entity_id] = 'ok'
+    return results
+
 #
 # Taken from https://github.com/wmcbrine/tivoremote.git
 #
@@ -205,45 +392,141 @@ def find_tivos_zc():
     serv.close()
     return tivos
 
+class TivoCapture:
+    """Bounded in-memory buffer of recent TiVo and zap2it exchanges.
+
+    Recording is a single deque append, so it is cheap enough to leave
+    enabled.  Nothing touches the disk until dump() is called.
+    """
+
+    def __init__(self, size=CAPTURE_SIZE):
+        self._entries = deque(maxlen=size)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def record(self, kind, host, request, response, latency):
+        self._entries.append((time.time(), kind, host, request, response, latency))
+
+    def entries(self):
+        # Copy first; deque iteration fails if another thread appends
+        return [
+            {
+                'time': stamp,
+                'kind': kind,
+                'host': host,
+                'request': request,
+                'response': response,
+                'latency_ms': round(latency * 1000, 1),
+            }
+            for stamp, kind, host, request, response, latency in list(self._entries)
+        ]
+
+    def dump(self, filename):
+        save_json(filename, self.entries())
+
+class TivoUnavailable(ConnectionError):
+    """Raised instead of connecting while a host's breaker is open."""
+
+class TivoBreaker:
+    """Per-host circuit breaker for the network remote port.
+
+    After BREAKER_THRESHOLD consecutive connect failures the breaker opens
+    and commands fail immediately instead of waiting out the socket
+    timeout.  Only a successful probe() closes it again.
+    """
+
+    def __init__(self, host, port, threshold=BREAKER_THRESHOLD):
+        self.host = host
+        self.port = port
+        self.threshold = threshold
+        self._failures = 0
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self._failures >= self.threshold
+
+    def check(self):
+        if self.is_open:
+            raise TivoUnavailable("{} is not responding".format(self.host))
+
+    def success(self):
+        with self._lock:
+            self._failures = 0
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures == self.threshold:
+                _LOGGER.warning("%s failed %d connects, pausing commands",
+                                self.host, self.threshold)
+
+    def probe(self, timeout=PROBE_TIMEOUT):
+        """Try a bare connect with a short timeout; close the breaker on success."""
+        try:
+            sock = socket.create_connection((self.host, self.port), timeout)
+            sock.close()
+        except OSError:
+            return False
+        self.success()
+        return True
+
 class TivoDevice(MediaPlayerDevice):
     """Representation of a Tivo receiver on the network."""
 
-    def __init__(self, name, host, port, device, zapclient, debug):
+    def __init__(self, name, host, port, device, zapclient, debug, capture=None,
+                 breaker=None, broker=None):
         """Initialize the device."""
         self._name = name
         self._host = host
         self._port = port
 
         self.zapclient = zapclient
+        self.capture = capture
+        self.breaker = breaker or TivoBreaker(host, port)
+        self.broker = broker
 
         self._is_standby = False
         self._current = {}
         self._ignore = {}
         self.sock = None
+        # Polls, service calls and bulk_command may all send at once
+        self._lock = threading.Lock()
 
         debug = bool(int(debug))
         self.debug = debug
 
-        self.get_status()
+        if broker is not None:
+            broker.add_listener(self.handle_push)
+
+        try:
+            self.get_status()
+        except OSError as err:
+            _LOGGER.warning("Unable to reach %s: %s", name, err)
 
     def connect(self, host, port):
+        self.breaker.check()
         try:
             if self.debug:
-                _LOGGER.info("Connecting to device...")
+                _LOGGER.debug("Connecting to device...")
             self.sock = socket.socket()
             self.sock.settimeout(5)
             self.sock.connect((host, port))
-        except Exception:
+        except OSError:
+            self.sock.close()
+            self.breaker.failure()
             raise
+        self.breaker.success()
 
     def disconnect(self):
         if self.debug:
-            _LOGGER.info("Disconnecting from device...")
+            _LOGGER.debug("Disconnecting from device...")
         self.sock.close()
 
     def get_status(self):
         if self.debug:
-            _LOGGER.info("get_status called...")
+            _LOGGER.debug("get_status called...")
         data = self.send_code('','')
         """ e.g. CH_STATUS 0645 LOCAL """
         """ e.g. CH_STATUS 0645 RECORDING """
@@ -251,6 +534,14 @@ class TivoDevice(MediaPlayerDevice):
         words = data.split()
         self.set_status(words)
 
+    def handle_push(self, line):
+        """Apply a CH_STATUS line pushed through the broker."""
+        if line.startswith('CH_STATUS'):
+            self.set_status(line.split())
+            # Not yet added to hass during __init__'s first status push
+            if self.hass is not None:
+                self.schedule_update_ha_state()
+
     def set_status(self, words):
         self._is_standby = True
 
@@ -292,9 +583,9 @@ class TivoDevice(MediaPlayerDevice):
             num = zap_ch.lstrip("0")
             ti  = self.zapclient.get_title(zap_ch)
             if self.debug:
-                _LOGGER.info("Channel:  %s", num)
-                _LOGGER.info("Callsign: %s", ch)
-                _LOGGER.info("Title:    %s", ti)
+                _LOGGER.debug("Channel:  %s", num)
+                _LOGGER.debug("Callsign: %s", ch)
+                _LOGGER.debug("Title:    %s", ti)
 
             self._current["title"] = "Ch. {} {}: {}".format(num, ch, ti)
             self._current["image"] = self.zapclient.get_image_url(zap_ch)
@@ -302,39 +593,60 @@ class TivoDevice(MediaPlayerDevice):
         self._is_standby = False
 
     def send_code(self, code, cmdtype="IRCODE", extra=0, bufsize=1024):
-        data = ""
         if extra:
             code = code + " " + extra
             # can be '', IRCODE, KEYBOARD, or TELEPORT.  Usually it's IRCODE but we might switch to KEYBOARD since it can do more.
 
-        try:
-            self.connect(self._host, self._port)
-            if code:
-                if cmdtype == '':
-                    tosend = code + "\r"
-                else:
-                    tosend = cmdtype + " " + code + "\r"
+        if code:
+            if cmdtype == '':
+                tosend = code + "\r"
             else:
-                tosend = ""
+                tosend = cmdtype + " " + code + "\r"
+        else:
+            tosend = ""
 
-            if self.debug:
-                _LOGGER.debug("Sending request: '%s'", tosend)
+        return self.transmit([tosend], bufsize)
 
-            try:
-                self.sock.sendall(tosend.encode())
+    def send_sequence(self, codes, cmdtype="IRCODE", bufsize=1024):
+        """Send several codes over a single connection."""
+        return self.transmit([cmdtype + " " + code + "\r" for code in codes], bufsize)
+
+    def transmit(self, commands, bufsize=1024):
+        # Commands go out 0.3s apart; the reply to the last one is returned
+        started = time.monotonic()
+        response = None
+        try:
+            with self._lock:
+                response = self.exchange(commands, bufsize)
+            return response
+        except Exception as err:
+            response = "{}: {}".format(type(err).__name__, err)
+            raise
+        finally:
+            if self.debug and self.capture is not None:
+                self.capture.record('tivo', self._host, ''.join(commands),
+                                    response, time.monotonic() - started)
+
+    def exchange(self, commands, bufsize=1024):
+        if self.broker is not None:
+            for tosend in commands[:-1]:
+                self.broker.forward(tosend)
                 time.sleep(0.3)
-                data = self.sock.recv(bufsize)
-                if self.debug:
-                    _LOGGER.debug("Received response: '%s'", data)
-            except socket.timeout:
-                if self.debug:
-                    _LOGGER.warning("Connection timed out...")
-                data = b'no_channel Video'
+            return self.broker.send(commands[-1]) or 'no_channel Video'
 
+        self.connect(self._host, self._port)
+        try:
+            for tosend in commands:
+                self.sock.sendall(tosend.encode())
+                time.sleep(0.3)
+            data = self.sock.recv(bufsize)
+        except socket.timeout:
+            if self.debug:
+                _LOGGER.warning("Connection timed out...")
+            data = b'no_channel Video'
+        finally:
             self.disconnect()
-            return data.decode()
-        except Exception:
-            raise
+        return data.decode()
 
     def channel_scan(self):
         for i in range(1, self._channel_max):
@@ -349,6 +661,11 @@ class TivoDevice(MediaPlayerDevice):
         """Return the name of the device."""
         return self._name
 
+    @property
+    def available(self):
+        """Return False while the host's breaker is open."""
+        return not self.breaker.is_open
+
     @property
     def state(self):
         """Return the state of the device."""
@@ -365,7 +682,7 @@ class TivoDevice(MediaPlayerDevice):
         """ LIVETV_READY before issuing a SETCH or FORCECH command. """
         data = self.send_code('LIVETV', 'TELEPORT')
         self._current["mode"] = "TV"
-        return data.decode()
+        return data
 
     @property
     def show_guide(self):
@@ -374,15 +691,15 @@ class TivoDevice(MediaPlayerDevice):
         """ Also returns status as with NOWPLAYING, e.g. CH_STATUS 0613 LOCAL """
         data = self.send_code('GUIDE', 'TELEPORT')
         self._current["mode"] = "GUIDE"
-        return data.decode()
+        return data
 
     @property
     def show_tivo(self):
         data = ""
         """Tivo menu."""
-        self.send_code('TIVO', 'TELEPORT')
+        data = self.send_code('TIVO', 'TELEPORT')
         self._current["mode"] = "MENU"
-        return data.decode()
+        return data
 
     @property
     def show_now(self):
@@ -390,7 +707,7 @@ class TivoDevice(MediaPlayerDevice):
         """Now playing."""
         data = self.send_code('NOWPLAYING', 'TELEPORT')
         self._current["mode"] = "NOWPLAYING"
-        return data.decode()
+        return data
 
     @property
     def show_vod(self):
@@ -398,11 +715,11 @@ class TivoDevice(MediaPlayerDevice):
         """ Activate Video on demand menu """
         data = self.send_code('VIDEO_ON_DEMAND','KEYBOARD')
         self._current["mode"] = "VIDEO"
-        return data.decode()
+        return data
 
     def channel_set(self, channel):
         """Channel set."""
-        data = self.show_live()
+        data = self.show_live
         #if(data.trim() == "LIVETV_READY"):
         self.send_code('SETCH', '', channel)
 
@@ -506,8 +823,8 @@ class TivoDevice(MediaPlayerDevice):
     def turn_off(self):
         """Turn off the receiver. """
         if self._is_standby == False:
-            self.send_code('STANDBY','IRCODE')
-            self.send_code('STANDBY','IRCODE')
+            # Second press confirms standby; keep both on one connection
+            self.send_sequence(['STANDBY', 'STANDBY'])
             self._is_standby = True
 
     def media_play(self):
@@ -569,27 +886,43 @@ class TivoDevice(MediaPlayerDevice):
 
 class Zap2ItClient:
 
-    def __init__(self, zapuser, zappass, debug=False):
+    def __init__(self, zapuser, zappass, debug=False, capture=None,
+                 guide_path=GUIDE_FILE, hours=1):
         self._zapuser = zapuser
         self._zappass = zappass
-        self.debug = debug
-
-        self._channels = {}
-        self._titles = {}
-        self._images = {}
+        self.debug = bool(int(debug))
+        self.capture = capture
+        self._guide_path = guide_path
+        self._hours = hours
 
+        # Reuse listings from a previous run if they are still current
+        self._guide = GuideStore.open(guide_path)
         self.update()
-    
+
     def get_callsign(self, ch):
-        return self._channels.get(ch)
+        if self._guide is None:
+            return None
+        return self._guide.get_callsign(ch)
 
     def get_title(self, ch):
-        return self._titles.get(ch)
+        if self._guide is None:
+            return None
+        return self._guide.get_title(ch, int(time.time()))
 
     def get_image_url(self, ch):
-        return self._images.get(ch)
+        if self._guide is None:
+            return None
+        thumbnail = self._guide.get_image(ch, int(time.time()))
+        if not thumbnail:
+            return ZAP_NO_IMAGE
+        return "https://zap2it.tmsimg.com/assets/" + thumbnail + ".jpg"
 
     def update(self):
+        # Only refetch once less than half of the configured window is left;
+        # until then the stored listings already cover what is on now
+        margin = self._hours * 3600 // 2
+        if self._guide is not None and self._guide.covers(int(time.time()) + margin):
+            return
         self.get_data()
 
     def login(self):
@@ -603,11 +936,17 @@ class Zap2ItClient:
         tosend_json = json.dumps(tosend).encode('utf8')
         header = {'content-type': 'application/json'}
 
-        req = urllib.request.Request(url=login, data=tosend_json, headers=header, method='POST')
-        res = urllib.request.urlopen(req, timeout=5)
+        started = time.monotonic()
+        try:
+            req = urllib.request.Request(url=login, data=tosend_json, headers=header, method='POST')
+            res = urllib.request.urlopen(req, timeout=5)
 
-        rawrtrn = res.read().decode('utf8')
-        rtrn = json.loads(rawrtrn)
+            rawrtrn = res.read().decode('utf8')
+            rtrn = json.loads(rawrtrn)
+        except Exception as err:
+            self.record(loginpath, "{}: {}".format(type(err).__name__, err), started)
+            raise
+        self.record(loginpath, 'ok', started)
 
         self._token = rtrn['token']
         if self.debug:
@@ -623,97 +962,69 @@ class Zap2ItClient:
             _LOGGER.debug("zapget_data called")
         self.login()
         now = int(time.time())
-        self._channels = {}
         zap_params = self.get_zap_params()
+        writer = GuideWriter()
+
+        # The grid API returns at most ZAP_CHUNK_HOURS per request
+        for offset in range(0, self._hours, ZAP_CHUNK_HOURS):
+            span = min(ZAP_CHUNK_HOURS, self._hours - offset)
+            self.get_grid(now + offset * 3600, span, zap_params, writer)
+
+        writer.write(self._guide_path)
+        self._guide = GuideStore.open(self._guide_path)
+
+    def get_grid(self, start, span, zap_params, writer):
         host = 'https://tvlistings.zap2it.com/'
 
-        # Only get 1 hour of programming since we only need/want the current program titles
-        #param = '?time=' + str(now) + '&timespan=0&pref=-&' + urlencode(zap_params) + '&TMSID=&FromPage=TV%20Grid&ActivityID=1&OVDID=&isOverride=true'
-        param = '?time=' + str(now) + '&timespan=1&pref=-&' + urlencode(zap_params) + '&TMSID=&FromPage=TV%20Grid&ActivityID=1&OVDID=&isOverride=true'
+        param = '?time=' + str(start) + '&timespan=' + str(span) + '&pref=-&' + urlencode(zap_params) + '&TMSID=&FromPage=TV%20Grid&ActivityID=1&OVDID=&isOverride=true'
         url = host + 'api/grid' + param
         if self.debug:
             _LOGGER.debug("Zapget url: %s", url)
 
         header = {'X-Requested-With': 'XMLHttpRequest'}
 
-        req = urllib.request.Request(url=url,headers=header, method='GET')
-        res = urllib.request.urlopen(req, timeout=5)
-
-        #self._raw = res.read().decode('utf8')
-        #self._zapraw = json.loads(self._raw)
-        #self._zapraw = json.loads(res.read().decode('utf8'))
+        request = 'api/grid?time=' + str(start) + '&timespan=' + str(span)
+        started = time.monotonic()
+        try:
+            req = urllib.request.Request(url=url,headers=header, method='GET')
+            res = urllib.request.urlopen(req, timeout=5)
+            raw = res.read()
+            zapraw = json.loads(raw.decode('utf8'))
+        except Exception as err:
+            self.record(request, "{}: {}".format(type(err).__name__, err), started)
+            raise
 
         if self.debug:
-            self._raw = res.read().decode('utf8')
-            self._zapraw = json.loads(self._raw)
-
-            f = open('/tmp/zapraw','w')
-            f.write(self._raw)
-            f.close()
-        else:
-            self._zapraw = json.loads(res.read().decode('utf8'))
-
-        self.get_channels()
-        self.get_titles()
-
-    def get_channels(self):
-        # Decode basic channel num to channel name from zap raw data
+            # Keep a summary only; the full grid is far too large to buffer
+            channels = zapraw.get('channels', [])
+            self.record(request, {
+                'bytes': len(raw),
+                'channels': len(channels),
+                'events': sum(len(c.get('events', [])) for c in channels),
+            }, started)
+
+        self.get_listings(zapraw, writer)
+
+    def record(self, request, response, started):
+        if self.debug and self.capture is not None:
+            self.capture.record('zap2it', 'tvlistings.zap2it.com', request,
+                                response, time.monotonic() - started)
+
+    def get_listings(self, zapraw, writer):
+        # Decode channel callsigns and program listings from zap raw data
         if self.debug:
-            _LOGGER.info("zapget_channels called")
-        for channelData in self._zapraw['channels']:
+            _LOGGER.debug("zapget_listings called")
+        for channelData in zapraw['channels']:
             # Pad channel numbers to 4 chars to match values from Tivo device
             _ch = channelData['channelNo'].zfill(4)
-            self._channels[_ch] = channelData['callSign']
-
-    def get_titles(self):
-        # Decode program titles from zap raw data
-        if self.debug:
-            _LOGGER.info("zapget_titles called")
-        self._titles = {}
-        self._images = {}
-        #self._start  = {}
-        #self._end    = {}
-
-        for channelData in self._zapraw['channels']:
-            _ch = channelData['channelNo'].zfill(4)
-            _ev = channelData['events']
-
-            tmp = _ev[0]
-            prog = tmp['program']
-
-            start_utc  = time.strptime(tmp['startTime'], "%Y-%m-%dT%H:%M:%SZ")
-            start_time = timegm(start_utc)
-#            starthm    = time.strftime("%H:%M",  timezone('US/Central').localize(start_utc))
-
-            end_utc    = time.strptime(tmp['endTime'], "%Y-%m-%dT%H:%M:%SZ")
-            end_time   = timegm(end_utc)
-#            #endhm   = time.strftime("%H:%M", end_utc)
-#            endhm   = time.strftime("%H:%M", timezone('US/Central').localize(end_utc))
-#
-#            pgmtime = ' (' + starthm + ' - ' + endhm + ')'
-
-            try:
-                if tmp['thumbnail'] != "":
-                    image = "https://zap2it.tmsimg.com/assets/" + tmp['thumbnail'] + ".jpg"
-                else:
-                    image = "https://tvlistings.zap2it.com/assets/images/noImage165x220.jpg"
-            except:
-                image = "https://tvlistings.zap2it.com/assets/images/noImage165x220.jpg"
-            self._images[_ch] = image
-
-            now = int(time.time())
-            if start_time < now < end_time:
-                title = prog['title']
-                self._titles[_ch] = title
-                try:
-                    if tmp['thumbnail'] != "":
-                        image = "https://zap2it.tmsimg.com/assets/" + tmp['thumbnail'] + ".jpg"
-                    else:
-                        image = "https://tvlistings.zap2it.com/assets/images/noImage165x220.jpg"
-                except:
-                    image = "https://tvlistings.zap2it.com/assets/images/noImage165x220.jpg"
-                self._images[_ch] = image
-                # + pgmtime
+            writer.add_channel(_ch, channelData['callSign'])
+
+            for event in channelData['events']:
+                start_utc = time.strptime(event['startTime'], "%Y-%m-%dT%H:%M:%SZ")
+                end_utc   = time.strptime(event['endTime'], "%Y-%m-%dT%H:%M:%SZ")
+                writer.add_event(_ch, timegm(start_utc), timegm(end_utc),
+                                 event['program']['title'],
+                                 event.get('thumbnail') or '')
 
     def get_zap_params(self):
         zparams = {}